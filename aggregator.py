@@ -1,19 +1,38 @@
 import os
+import re
+import csv
+import base64
+import zlib
+import json
+import hashlib
+import calendar
+import functools
 import StringIO
+import unicodedata
 import datetime
 import logging
 
-from pandas import DataFrame
+import redis
+import gridfs
+import pyarrow as pa
+import pyarrow.parquet as pq
+
 from raven.contrib.flask import Sentry
 
 from flask_cors import CORS
 from flask import Flask
+from flask import Response
+from flask import abort
+from flask import jsonify
 from flask import redirect
 from flask import request
-from flask import send_file
+from flask import has_request_context
 from flask import url_for
+from flask import g
 from flask.ext import admin
 from flask.ext.mongoengine import MongoEngine
+from mongoengine.connection import get_db
+from mongoengine.queryset import QuerySet
 from flask.ext.mongoengine.json import MongoEngineJSONEncoder
 from flask.ext.admin.contrib.mongoengine import ModelView
 from flask.ext.admin import expose, helpers
@@ -32,6 +51,8 @@ import flask_login as login
 from flask_login import AnonymousUserMixin
 
 from bson import ObjectId
+from bson import json_util
+from bson.errors import InvalidId
 from wtforms import form, fields, validators
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -68,6 +89,11 @@ db.init_app(app)
 login_manager.init_app(app)
 app.json_encoder = JSONEncoder
 
+# Create response cache, entries are invalidated by bumping the generation
+cache = redis.StrictRedis.from_url(app.config['CELERY_BROKER_URL'])
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 4 * 60 * 60))
+GENERATION_KEY = 'reports:generation'
+
 
 # Create user loader function
 @login_manager.user_loader
@@ -199,6 +225,62 @@ class CartoDbTable(db.Document):
     target_list = db.StringField()
 
 
+# report fields searched from the admin, they are covered by a text
+# index and by normalised search keys for prefix searches
+SEARCH_FIELDS = [
+    'db_name',
+    'date',
+    'p_code',
+    'category',
+    'activity',
+    'partner_name',
+    'location_name',
+    'indicator_name',
+    'comments',
+    'gov_code',
+    'governorate',
+    'district_code',
+    'district',
+    'cadastral_code',
+    'cadastral'
+]
+
+# report fields maintained by the importer, not shown to users
+INTERNAL_FIELDS = ('fingerprint', 'search_keys')
+
+# search keys are cut to this many characters, mongo before 4.2
+# rejects writes with index keys over 1024 bytes
+SEARCH_KEY_LENGTH = 100
+
+
+def normalise(value):
+    """
+    Lower cases a value and strips its accents
+    """
+    value = unicodedata.normalize('NFKD', unicode(value))
+    return u''.join(
+        char for char in value if not unicodedata.combining(char)
+    ).lower().strip()
+
+
+def search_keys(values):
+    """
+    Lists each value, and each word in it, normalised
+    and cut to SEARCH_KEY_LENGTH characters
+    """
+    keys = set()
+    for value in values:
+        if value:
+            value = normalise(value)
+            keys.add(value[:SEARCH_KEY_LENGTH])
+            keys.update(
+                word[:SEARCH_KEY_LENGTH]
+                for word in re.split(r'\W+', value, flags=re.UNICODE)
+            )
+    keys.discard(u'')
+    return sorted(keys)
+
+
 class Attribute(db.EmbeddedDocument):
     name = db.StringField()
     value = db.StringField()
@@ -217,8 +299,8 @@ class Report(db.Document):
     location_id = db.IntField()
     location_name = db.StringField()
     location_type = db.StringField()
-    location_x = db.DecimalField()
-    location_y = db.DecimalField()
+    location_x = db.FloatField()
+    location_y = db.FloatField()
     gov_code = db.StringField()
     governorate = db.StringField()
     district_code = db.StringField()
@@ -228,15 +310,31 @@ class Report(db.Document):
     indicator_id = db.IntField()
     indicator_category = db.StringField()
     indicator_name = db.StringField()
-    value = db.DecimalField()
+    value = db.FloatField()
     units = db.StringField()
     comments = db.StringField()
+    fingerprint = db.StringField()
+    search_keys = db.ListField(db.StringField())
     attributes = db.ListField(
         db.EmbeddedDocumentField(Attribute)
     )
 
     meta = {
+        # built by manage.py indexes, not on first access from a request
+        'auto_create_index': False,
+        'index_background': True,
         'indexes': [
+            {
+                'fields': [
+                    'db_name',
+                    'date',
+                    'site_id',
+                    'activity_id',
+                    'partner_id',
+                    'indicator_id',
+                ],
+                'unique': True,
+            },
             'date',
             'db_name',
             'p_code',
@@ -251,23 +349,482 @@ class Report(db.Document):
             'district_code',
             'district',
             'cadastral_code',
-            'cadastral'
+            'cadastral',
+            {
+                'fields': [
+                    'attributes.name',
+                    'attributes.value',
+                ],
+            },
+            'search_keys',
+            {
+                'fields': ['$' + field for field in SEARCH_FIELDS],
+                'default_language': 'none',
+            },
+        ]
+    }
+
+    def set_search_keys(self):
+        self.search_keys = search_keys(
+            getattr(self, field) for field in SEARCH_FIELDS)
+
+
+class RunStage(db.EmbeddedDocument):
+    name = db.StringField()
+    seconds = db.FloatField()
+    rows = db.IntField()
+    mongo_calls = db.IntField()
+    http_calls = db.IntField()
+    peak_memory = db.IntField()
+
+
+class ImportRun(db.Document):
+    command = db.StringField()
+    args = db.DictField()
+    status = db.StringField()
+    error = db.StringField()
+    started = db.DateTimeField()
+    finished = db.DateTimeField()
+    seconds = db.FloatField()
+    mongo_calls = db.IntField()
+    http_calls = db.IntField()
+    peak_memory = db.IntField()
+    stages = db.ListField(
+        db.EmbeddedDocumentField(RunStage)
+    )
+
+    meta = {
+        'collection': 'runs',
+        'ordering': ['-started'],
+        'indexes': [
+            ('command', '-started'),
         ]
     }
 
 
 class FilterByAttribute(BaseMongoEngineFilter):
+    """
+    Filters on the value of the attribute named by the filter,
+    options default to the attribute's distinct values
+    """
+
+    def get_options(self, view):
+        if self.options is not None:
+            return super(FilterByAttribute, self).get_options(view)
+        # options are looked up per request, not when the view is created
+        if not has_request_context():
+            return None
+        return attribute_options(self.name)
+
     def apply(self, query, value):
+        # matching name and value in one element uses the compound index
         flt = {
             '__raw__':
                 {'attributes':
-                     {'$elemMatch': {self.column: value}}}}
+                     {'$elemMatch': {'name': self.name, self.column: value}}}}
         return query.filter(**flt)
 
     def operation(self):
         return gettext('value')
 
 
+def aggregate(collection, pipeline):
+    """
+    Runs a pipeline returning a cursor, servers from 3.6 on no longer
+    return results inline and a cursor has no 16MB result limit
+    """
+    return collection.aggregate(pipeline, allowDiskUse=True, cursor={})
+
+
+def bump_generation():
+    """
+    Invalidates cached responses and counts, called when an import changes reports.
+    When redis is unavailable cached entries expire after CACHE_TTL instead.
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except redis.RedisError as exp:
+        app.logger.warning(
+            'Response cache not invalidated, entries expire after %ss: %r',
+            CACHE_TTL, exp)
+
+
+def cache_key(*parts):
+    return hashlib.md5(json.dumps(
+        [cache.get(GENERATION_KEY)] + list(parts),
+        sort_keys=True,
+        default=lambda o: getattr(o, 'pattern', unicode(o))
+    )).hexdigest()
+
+
+def attribute_options(name):
+    """
+    Lists the attributes of the groups with this name, as stored
+    in attributeGroups by the import of each database. Cached until
+    the next import changes reports, only attributes of those reports
+    can match a filter.
+    """
+    try:
+        key = 'options:' + cache_key(name)
+        cached = cache.get(key)
+    except redis.RedisError:
+        key = cached = None
+    if cached is not None:
+        return [tuple(option) for option in json.loads(cached)]
+
+    values = get_db()['attributeGroups'].find(
+        {'name': name}).distinct('attributes.name')
+    options = [(value, value) for value in sorted(values) if value]
+    if key is not None:
+        try:
+            cache.setex(key, CACHE_TTL, json.dumps(options))
+        except redis.RedisError:
+            pass
+    return options
+
+
+def cached_payload(func):
+    """
+    Caches the data a view builds by path and normalised query until
+    the next import and tags the response with an ETag for it.
+    The data is built uncached when redis is unavailable.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            etag = cache_key(
+                func.__name__,
+                request.path,
+                sorted(request.args.items(multi=True))
+            )
+            key = 'payload:' + etag
+            cached = cache.get(key)
+        except redis.RedisError as exp:
+            app.logger.warning('Response cache unavailable: %r', exp)
+            return func(*args, **kwargs)
+
+        g.etag = etag
+        if cached is not None:
+            return json.loads(cached)
+        payload = func(*args, **kwargs)
+        try:
+            cache.setex(key, CACHE_TTL, json.dumps(payload, default=unicode))
+        except redis.RedisError as exp:
+            app.logger.warning('Response cache unavailable: %r', exp)
+        return payload
+    return wrapper
+
+
+@app.after_request
+def set_etag(response):
+    # answers a matching If-None-Match with 304
+    etag = getattr(g, 'etag', None)
+    if etag and response.status_code == 200:
+        response.set_etag(etag)
+        response.make_conditional(request)
+    return response
+
+
+class ReportQuerySet(QuerySet):
+    """
+    Caches counts until the next import changes reports. Unfiltered
+    counts come from the collection metadata and filtered counts
+    stop at count_limit.
+    """
+    count_limit = 100000
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return super(ReportQuerySet, self).count(with_limit_and_skip)
+        if not self._query:
+            return self._collection.count()
+        try:
+            key = 'count:' + cache_key(self._query)
+            count = cache.get(key)
+        except redis.RedisError:
+            key = count = None
+        if count is None:
+            count = self.clone().limit(self.count_limit).count(
+                with_limit_and_skip=True)
+            if key is not None:
+                try:
+                    cache.setex(key, CACHE_TTL, count)
+                except redis.RedisError:
+                    pass
+        return int(count)
+
+
+def export_cache():
+    return gridfs.GridFS(get_db(), 'exports')
+
+
+def clear_export_cache():
+    """
+    Removes all cached exports, called when an import changes reports,
+    returns the number removed
+    """
+    fs = export_cache()
+    removed = 0
+    for grid_out in fs.find():
+        fs.delete(grid_out._id)
+        removed += 1
+    return removed
+
+
+class ChunkSink(object):
+    """
+    Write only file that hands back what has been written since the
+    last drain, tell() counts every byte so writers can record offsets
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def number(value):
+    """
+    Reads a stored value as a float, reports not yet migrated and values
+    migrate_values could not convert are strings, None if not a number
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ReportExport(object):
+    """
+    Writes the reports matching a raw mongo query as csv, gzipped csv,
+    parquet or arrow. Outputs are cached in GridFS by query and format.
+    """
+    batch_size = 1000
+    excluded = ('id', 'attributes') + INTERNAL_FIELDS
+    formats = {
+        'csv': ('csv', 'text/csv'),
+        'csv.gz': ('csv.gz', 'application/gzip'),
+        'parquet': ('parquet', 'application/octet-stream'),
+        'arrow': ('arrow', 'application/vnd.apache.arrow.file'),
+    }
+
+    def __init__(self, spec, ordering=None):
+        self.spec = spec
+        self.ordering = ordering or []
+        self.collection = Report._get_collection()
+        self.fields = [
+            Report._fields[name] for name in Report._fields_ordered
+            if name not in self.excluded
+        ]
+
+    def key(self, format):
+        # compiled search regexes are keyed on their pattern
+        return hashlib.md5(json.dumps(
+            [format, self.spec, self.ordering],
+            sort_keys=True,
+            default=lambda o: getattr(o, 'pattern', unicode(o))
+        )).hexdigest()
+
+    def attribute_names(self):
+        return sorted(
+            self.collection.find(self.spec).distinct('attributes.name'))
+
+    def documents(self):
+        projection = dict((field.db_field, 1) for field in self.fields)
+        projection['attributes'] = 1
+        cursor = self.collection.find(
+            self.spec, projection).batch_size(self.batch_size)
+        if self.ordering:
+            cursor = cursor.sort(self.ordering)
+        return cursor
+
+    def rows(self, attributes):
+        for doc in self.documents():
+            values = dict(
+                (attr['name'], attr.get('value'))
+                for attr in doc.get('attributes', [])
+            )
+            yield (
+                [doc.get(field.db_field) for field in self.fields] +
+                [values.get(name) for name in attributes]
+            )
+
+    def csv(self):
+        def encode(value):
+            if value is None:
+                return ''
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            return value
+
+        attributes = self.attribute_names()
+        buffer = StringIO.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(
+            [''] +
+            [field.db_field for field in self.fields] +
+            [encode(name) for name in attributes]
+        )
+        for i, row in enumerate(self.rows(attributes)):
+            writer.writerow([i] + [encode(value) for value in row])
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def csv_gz(self):
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in self.csv():
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def attribute_dictionary(self):
+        return pa.array(sorted(
+            value for value in
+            self.collection.find(self.spec).distinct('attributes.value')
+            if value is not None
+        ), type=pa.string())
+
+    def schema(self, attributes):
+        types = []
+        for field in self.fields:
+            if isinstance(field, db.FloatField):
+                types.append(pa.float64())
+            elif isinstance(field, db.IntField):
+                types.append(pa.int64())
+            else:
+                types.append(pa.string())
+        types.extend(
+            pa.dictionary(pa.int32(), pa.string()) for name in attributes)
+        return pa.schema([
+            pa.field(name, type) for name, type in zip(
+                [field.db_field for field in self.fields] + attributes, types)
+        ])
+
+    def batches(self, schema, attributes):
+        """
+        Yields typed record batches of batch_size reports, attribute
+        columns are dictionary encoded against one dictionary of all
+        the attribute values so every batch shares it
+        """
+        dictionary = self.attribute_dictionary()
+        positions = dict(
+            (value, i) for i, value in enumerate(dictionary.to_pylist()))
+
+        def batch(columns):
+            arrays = [
+                pa.array(
+                    [number(value) for value in column]
+                    if field.type == pa.float64() else column,
+                    type=field.type)
+                for column, field in zip(columns, schema)[:len(self.fields)]
+            ]
+            arrays.extend(
+                pa.DictionaryArray.from_arrays(pa.array(
+                    [positions.get(value) for value in column],
+                    type=pa.int32()), dictionary)
+                for column in columns[len(self.fields):]
+            )
+            return pa.RecordBatch.from_arrays(arrays, schema.names)
+
+        columns = [[] for field in schema]
+        for row in self.rows(attributes):
+            for column, value in zip(columns, row):
+                column.append(value)
+            if len(columns[0]) >= self.batch_size:
+                yield batch(columns)
+                columns = [[] for field in schema]
+        if columns[0]:
+            yield batch(columns)
+
+    def parquet(self):
+        attributes = self.attribute_names()
+        schema = self.schema(attributes)
+        sink = ChunkSink()
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+        for batch in self.batches(schema, attributes):
+            writer.write_table(pa.Table.from_batches([batch]))
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+
+    def arrow(self):
+        attributes = self.attribute_names()
+        schema = self.schema(attributes)
+        sink = ChunkSink()
+        writer = pa.RecordBatchFileWriter(pa.PythonFile(sink, mode='w'), schema)
+        for batch in self.batches(schema, attributes):
+            writer.write_batch(batch)
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+
+    def cached(self, key, chunks):
+        """
+        Passes chunks through while storing them, the cached
+        file only becomes visible once it has been fully written
+        and an aborted download leaves nothing behind
+        """
+        fs = export_cache()
+        grid_in = fs.new_file(filename=key)
+        complete = False
+        try:
+            for chunk in chunks:
+                grid_in.write(chunk)
+                yield chunk
+            grid_in.close()
+            complete = True
+        finally:
+            if not complete:
+                fs.delete(grid_in._id)
+
+    def response(self, format):
+        if format not in self.formats:
+            abort(400)
+        extension, mimetype = self.formats[format]
+
+        key = self.key(format)
+        fs = export_cache()
+        if fs.exists(filename=key):
+            chunks = fs.get_last_version(key)
+        else:
+            chunks = self.cached(
+                key, getattr(self, format.replace('.', '_'))())
+
+        filename = "ai_reports_" + datetime.datetime.now().strftime("%Y_%m_%d_%H_%M") + "." + extension
+        return Response(
+            chunks,
+            mimetype=mimetype,
+            headers={
+                'Content-Disposition': 'attachment; filename={}'.format(filename)
+            }
+        )
+
+
 # Customized admin views
 class AdminView(ModelView):
 
@@ -296,6 +853,27 @@ class CartoDBTableView(AdminView):
             )
 
 
+class ImportRunView(AdminView):
+    can_create = False
+    can_delete = False
+    can_edit = False
+
+    column_list = [
+        'command',
+        'status',
+        'started',
+        'finished',
+        'seconds',
+        'mongo_calls',
+        'http_calls',
+        'peak_memory',
+    ]
+    column_filters = [
+        'command',
+        'status',
+    ]
+
+
 class ReportView(ModelView):
     can_create = False
     can_delete = False
@@ -319,36 +897,9 @@ class ReportView(ModelView):
         'district',
         'cadastral_code',
         'cadastral',
-        FilterByAttribute(
-            'value',
-            'RRP6 result',
-            options=(
-                ('Yes', u'Yes'),
-                ('No', u'No'),
-            ),
-        ),
-        FilterByAttribute(
-            'value',
-            'Funded by',
-            options=(
-                ('UNICEF', u'UNICEF'),
-                ('UNHCR', u'UNHCR'),
-                ('UNRWA', u'UNRWA'),
-                ('UNHCR', u'UNHCR'),
-                ('Independent', u'Independent'),
-            ),
-        ),
-        FilterByAttribute(
-            'value',
-            'Location type',
-            options=(
-                ('Palestinian Camp', u'Palestinian Camp'),
-                ('School', u'School'),
-                ('ITS', u'ITS'),
-                ('Other', u'Other'),
-                ('Distribution Site', u'Distribution Site'),
-            ),
-        ),
+        FilterByAttribute('value', 'RRP6 result'),
+        FilterByAttribute('value', 'Funded by'),
+        FilterByAttribute('value', 'Location type'),
     ]
     column_list = [
         'db_name',
@@ -363,23 +914,7 @@ class ReportView(ModelView):
         'comments',
     ]
 
-    column_searchable_list = [
-        'db_name',
-        'date',
-        'p_code',
-        'category',
-        'activity',
-        'partner_name',
-        'location_name',
-        'indicator_name',
-        'comments',
-        'gov_code',
-        'governorate',
-        'district_code',
-        'district',
-        'cadastral_code',
-        'cadastral'
-    ]
+    column_searchable_list = SEARCH_FIELDS
 
     form_subdocuments = {
         'attributes': {
@@ -392,8 +927,116 @@ class ReportView(ModelView):
         }
     }
 
-    @expose('/export')
-    def export(self):
+    def get_query(self):
+        return ReportQuerySet(Report, Report._get_collection())
+
+    def keyset_token(self, report, sort_column):
+        value = None
+        if sort_column:
+            field = Report._fields[sort_column]
+            value = getattr(report, sort_column)
+            value = field.to_mongo(value) if value is not None else None
+        # json_util keeps the stored type and full float precision
+        return base64.urlsafe_b64encode(json_util.dumps([value, report.id]))
+
+    def keyset_filter(self, db_field, value, last_id, descending):
+        """
+        Matches the reports after (value, last_id) in the sort order.
+        Mongo sorts null and missing values before all others, so they
+        need their own branches, comparisons never match them.
+        """
+        op = '$lt' if descending else '$gt'
+        if value is None:
+            after = [{db_field: None, '_id': {op: last_id}}]
+            if not descending:
+                after.append({db_field: {'$ne': None}})
+        else:
+            after = [
+                {db_field: {op: value}},
+                {db_field: value, '_id': {op: last_id}},
+            ]
+            if descending:
+                after.append({db_field: None})
+        return {'$or': after}
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True):
+        """
+        Pages the list with after/before tokens holding the sort value
+        and _id of the last/first report shown, instead of skipping
+        """
+        count, query = super(ReportView, self).get_list(
+            None, sort_column, sort_desc, search, filters, execute=False)
+        if not execute:
+            return count, query
+        g.count_capped = bool(query._query) and count >= query.count_limit
+
+        after, before = request.args.get('after'), request.args.get('before')
+        try:
+            value, last_id = json_util.loads(base64.urlsafe_b64decode(
+                str(after or before))) if after or before else (None, None)
+        except (TypeError, ValueError):
+            abort(400)
+        if last_id is not None and not isinstance(last_id, ObjectId):
+            abort(400)
+
+        # previous pages are read backwards from the first report shown
+        descending = bool(sort_desc) != bool(before)
+        direction = '-' if descending else '+'
+        op = '$lt' if descending else '$gt'
+        order = [direction + 'id']
+        if sort_column:
+            order.insert(0, direction + sort_column)
+        query = query.order_by(*order).limit(self.page_size + 1)
+
+        if last_id:
+            if sort_column:
+                query = query.filter(__raw__=self.keyset_filter(
+                    Report._fields[sort_column].db_field,
+                    value, last_id, descending))
+            else:
+                query = query.filter(__raw__={'_id': {op: last_id}})
+
+        data = list(query)
+        more = len(data) > self.page_size
+        data = data[:self.page_size]
+        if before:
+            data.reverse()
+
+        args = request.args.to_dict()
+        args.pop('after', None)
+        args.pop('before', None)
+        args.pop('page', None)
+        g.keyset = {'next': None, 'prev': None}
+        if data and (before or more):
+            g.keyset['next'] = url_for(
+                '.index_view', after=self.keyset_token(data[-1], sort_column), **args)
+        if data and (after or (before and more)):
+            g.keyset['prev'] = url_for(
+                '.index_view', before=self.keyset_token(data[0], sort_column), **args)
+        return count, data
+
+    @expose('/')
+    def index_view(self):
+        # attribute filter options follow the imported data
+        self._refresh_filters_cache()
+        return super(ReportView, self).index_view()
+
+    def _search(self, query, search_term):
+        """
+        Searches with the text index, or the normalised search
+        keys when the term starts with ^ for a prefix search
+        """
+        if search_term.startswith('^'):
+            prefix = normalise(search_term[1:])[:SEARCH_KEY_LENGTH]
+            return query.filter(__raw__={
+                'search_keys': {'$regex': '^' + re.escape(prefix)}
+            })
+        return query.filter(__raw__={'$text': {'$search': search_term}})
+
+    def export_query(self):
+        """
+        Returns the raw mongo filter and ordering for the current list arguments
+        """
         # Grab parameters from URL
         args = self._get_list_extra_args()
         page, sort_idx, sort_desc, search, filters = \
@@ -402,37 +1045,21 @@ class ReportView(ModelView):
         if sort_column is not None:
             sort_column = sort_column[0]
 
-        # Get count and data
-        self.page_size = request.args.get('count', 0, type=int)
-        count, data = self.get_list(
+        count, query = self.get_list(
             None,
             sort_column,
             sort_desc,
             search,
-            filters
+            filters,
+            execute=False
         )
+        return query._query, query._ordering
 
-        dicts = []
-        for report in data:
-            dict = report.to_mongo().to_dict()
-            del dict['_id']
-            del dict['attributes']
-            for attr in report.attributes:
-                dict[attr.name] = attr.value
-            dicts.append(dict)
-        df = DataFrame.from_records(dicts)
-
-        buffer = StringIO.StringIO()  # use stringio for temp file
-        df.to_csv(buffer, encoding='utf-8')
-        buffer.seek(0)
-
-        filename = "ai_reports_" + datetime.datetime.now().strftime("%Y_%m_%d_%H_%M") + ".csv"
-        return send_file(
-            buffer,
-            attachment_filename=filename,
-            as_attachment=True,
-            mimetype='text/csv'
-        )
+    @expose('/export')
+    def export(self):
+        spec, ordering = self.export_query()
+        return ReportExport(spec, ordering).response(
+            request.args.get('format', 'csv'))
 
     # def is_accessible(self):
     #     if login.current_user.is_authenticated():
@@ -448,6 +1075,7 @@ admin = admin.Admin(app, 'ActivityInfo Reports', index_view=MyAdminIndexView(),
 admin.add_view(ReportView(Report))
 admin.add_view(AdminView(User))
 admin.add_view(CartoDBTableView(CartoDbTable))
+admin.add_view(ImportRunView(ImportRun, name='Import runs'))
 
 # Add API
 api = MongoRest(app)
@@ -467,6 +1095,8 @@ class NeNone(ops.Ne):
 
 class ReportResource(Resource):
     paginate = False
+    page_limit = 1000
+    max_page_limit = 10000
     document = Report
     related_resources = {
         'attributes': AttributeResource,
@@ -491,12 +1121,137 @@ class ReportResource(Resource):
     #         all=True, qs=qs, qfilter=qfilter
     #     )
 
+    def get_filtered_queryset(self):
+        """
+        Applies the request filters without fetching any documents
+        """
+        qs = self.get_queryset()
+        for key, value in request.args.items():
+            field, _, op_name = key.partition('__')
+            for op in self.filters.get(field, []):
+                if op.op == (op_name or 'exact'):
+                    qs = op().apply(qs, field, value)
+                    break
+        return qs
+
+    def serialize_raw(self, doc):
+        data = {}
+        for name, value in doc.items():
+            if name == '_id':
+                data['id'] = str(value)
+            elif name in INTERNAL_FIELDS:
+                continue
+            else:
+                data[name] = value
+        return data
+
+    @cached_payload
+    def get_page(self):
+        """
+        Returns one page of reports ordered by _id, limited to the
+        fields= projection if given. The opaque next token carries the
+        last _id so deep pages cost the same as the first.
+        """
+        try:
+            limit = min(
+                request.args.get('limit', self.page_limit, type=int),
+                self.max_page_limit
+            )
+            after = request.args.get('next')
+            if after:
+                after = ObjectId(base64.urlsafe_b64decode(str(after)))
+        except (TypeError, ValueError, InvalidId):
+            abort(400)
+
+        projection = None
+        if request.args.get('fields'):
+            fields = request.args['fields'].split(',')
+            if not set(fields) <= set(Report._fields) - set(INTERNAL_FIELDS):
+                abort(400)
+            projection = dict(
+                (Report._fields[field].db_field, 1) for field in fields)
+
+        spec = self.get_filtered_queryset()._query
+        if after:
+            spec = {'$and': [spec, {'_id': {'$gt': after}}]}
+        docs = list(
+            Report._get_collection().find(
+                spec, projection).sort('_id', 1).limit(limit + 1)
+        )
+
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+        return {
+            'data': [self.serialize_raw(doc) for doc in docs],
+            'has_more': has_more,
+            'next': base64.urlsafe_b64encode(
+                str(docs[-1]['_id'])) if has_more else None,
+        }
+
+    @cached_payload
+    def get_aggregate(self):
+        """
+        Groups the filtered reports by the group_by dimensions, any of
+        the filterable fields, and returns the requested metrics:
+        sum (of value), count and distinct:<field> of a filterable field
+        """
+        group_by = [
+            field for field in request.args.get('group_by', '').split(',') if field
+        ]
+        metrics = request.args.get('metrics', 'sum,count').split(',')
+        if not set(group_by) <= set(self.filters):
+            abort(400)
+
+        def column(field):
+            return '$' + Report._fields[field].db_field
+
+        group = {'_id': dict((field, column(field)) for field in group_by)}
+        for metric in metrics:
+            name, _, field = metric.partition(':')
+            if name == 'sum':
+                group['sum'] = {'$sum': '$value'}
+            elif name == 'count':
+                group['count'] = {'$sum': 1}
+            elif name == 'distinct' and field in self.filters:
+                group['distinct_' + field] = {'$addToSet': column(field)}
+            else:
+                abort(400)
+
+        pipeline = [
+            {'$match': self.get_filtered_queryset()._query},
+            {'$group': group},
+            {'$sort': {'_id': 1}},
+        ]
+        data = []
+        for row in aggregate(Report._get_collection(), pipeline):
+            item = row.pop('_id')
+            for name, value in row.items():
+                item[name] = len(value) if isinstance(value, list) else value
+            data.append(item)
+        return {'data': data}
+
 
 @api.register(name='reports', url='/reports/')
 class ReportsView(ResourceView):
     resource = ReportResource
     methods = [methods.List]
 
+    def get(self, **kwargs):
+        # mimerender renders the returned dict
+        return self._resource.get_page()
+
+
+@app.route('/reports/export')
+def reports_export():
+    qs = ReportResource().get_filtered_queryset()
+    return ReportExport(qs._query, qs._ordering).response(
+        request.args.get('format', 'csv'))
+
+
+@app.route('/reports/aggregate')
+def reports_aggregate():
+    return jsonify(ReportResource().get_aggregate())
+
 
 # Flask views
 @app.route('/')
@@ -504,6 +1259,49 @@ def index():
     return redirect('/admin')
 
 
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus text format metrics for the latest run of each command,
+    and of each database for commands run per database like import_ai
+    """
+    latest = []
+    for command in ImportRun.objects.distinct('command'):
+        runs = ImportRun.objects(command=command).order_by('-started')
+        dbs = ImportRun._get_collection().find(
+            {'command': command, 'args.dbs': {'$exists': True}}
+        ).distinct('args.dbs')
+        if dbs:
+            for db_ids in sorted(dbs):
+                latest.append((
+                    'command="{}",dbs="{}"'.format(command, db_ids),
+                    runs.filter(__raw__={'args.dbs': db_ids}).first()
+                ))
+        else:
+            latest.append(('command="{}"'.format(command), runs.first()))
+
+    lines = []
+    for labels, run in latest:
+        lines.extend([
+            'ai_run_success{{{}}} {}'.format(labels, int(run.status == 'success')),
+            'ai_run_started_timestamp{{{}}} {}'.format(
+                labels, calendar.timegm(run.started.utctimetuple())),
+            'ai_run_seconds{{{}}} {}'.format(labels, run.seconds or 0),
+            'ai_run_mongo_calls{{{}}} {}'.format(labels, run.mongo_calls or 0),
+            'ai_run_http_calls{{{}}} {}'.format(labels, run.http_calls or 0),
+            'ai_run_peak_memory_bytes{{{}}} {}'.format(labels, run.peak_memory or 0),
+        ])
+        for stage in run.stages:
+            stage_labels = '{},stage="{}"'.format(labels, stage.name)
+            lines.extend([
+                'ai_stage_seconds{{{}}} {}'.format(stage_labels, stage.seconds),
+                'ai_stage_rows{{{}}} {}'.format(stage_labels, stage.rows),
+                'ai_stage_mongo_calls{{{}}} {}'.format(stage_labels, stage.mongo_calls),
+                'ai_stage_http_calls{{{}}} {}'.format(stage_labels, stage.http_calls),
+            ])
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     # Start app
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the import, update_levels and update_sites pipelines.
+
+ActivityInfo and CartoDB responses are recorded to and replayed from a
+fixtures directory, and import_ai can run against a synthetic database
+of sites x indicators x months. Point MONGODB_URL at a local scratch
+mongod, reports and lookup tables are written to it. The synthetic
+import skips the cache invalidation, so redis is not needed.
+"""
+
+import os
+import json
+import time
+import base64
+import random
+import hashlib
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from flask.ext.script import Manager
+
+import manage
+from manage import (
+    ImportRun,
+    RunMetrics,
+    Stage,
+    prepare_database,
+    import_month,
+    LocationCache,
+)
+
+bench = Manager(manage.app)
+
+
+class HttpRecorder(object):
+    """
+    Records every response sent through requests into a fixtures
+    directory, or replays them from it without touching the network.
+    Requests are keyed on method, url and body.
+    """
+
+    def __init__(self, fixtures, record=False):
+        self.fixtures = fixtures
+        self.record = record
+        self.calls = 0
+        self.original = HTTPAdapter.send
+        if not os.path.isdir(fixtures):
+            os.makedirs(fixtures)
+
+    def path(self, request):
+        key = hashlib.sha1('{} {} {}'.format(
+            request.method, request.url, request.body or '')).hexdigest()
+        return os.path.join(self.fixtures, key + '.json')
+
+    def send(self, adapter, request, **kwargs):
+        self.calls += 1
+        path = self.path(request)
+
+        if not self.record:
+            if not os.path.exists(path):
+                raise requests.ConnectionError(
+                    'No fixture for {} {}'.format(request.method, request.url))
+            with open(path) as fixture:
+                data = json.load(fixture)
+            response = requests.Response()
+            response.status_code = data['status']
+            response.headers = CaseInsensitiveDict(data['headers'])
+            response.encoding = data['encoding']
+            response._content = base64.b64decode(data['content'])
+            response.url = request.url
+            response.request = request
+            return response
+
+        response = self.original(adapter, request, **kwargs)
+        with open(path, 'w') as fixture:
+            json.dump({
+                'method': request.method,
+                'url': request.url,
+                'status': response.status_code,
+                'headers': dict(response.headers),
+                'encoding': response.encoding,
+                'content': base64.b64encode(response.content),
+            }, fixture)
+        return response
+
+    def __enter__(self):
+        recorder = self
+
+        def send(adapter, request, **kwargs):
+            return recorder.send(adapter, request, **kwargs)
+
+        HTTPAdapter.send = send
+        # payload ids are random, seed them so recorded bodies match
+        random.seed(0)
+        return self
+
+    def __exit__(self, *exc_info):
+        HTTPAdapter.send = self.original
+
+
+class SyntheticClient(object):
+    """
+    Stands in for ActivityInfoClient with a generated database where
+    every site reports each of its indicators every month
+    """
+
+    def __init__(self, sites=1000, indicators=20, activities=10, partners=20, seed=0):
+        self.sites = int(sites)
+        self.indicators = int(indicators)
+        self.activities = int(activities)
+        self.partners = int(partners)
+        self.seed = int(seed)
+        self.calls = 0
+
+    def get_database(self, db_id):
+        self.calls += 1
+        return {
+            'id': db_id,
+            'name': 'Synthetic {}'.format(db_id),
+            'activities': [
+                {
+                    'id': activity,
+                    'name': 'Activity {}'.format(activity),
+                    'category': 'Category {}'.format(activity % 3),
+                    'locationType': {'id': 1, 'name': 'Site'},
+                    'attributeGroups': [{
+                        'id': activity,
+                        'name': 'Group {}'.format(activity),
+                        'mandatory': False,
+                        'attributes': [
+                            {'id': activity * 10 + i, 'name': 'Attribute {}'.format(i)}
+                            for i in range(3)
+                        ],
+                    }],
+                }
+                for activity in range(1, self.activities + 1)
+            ],
+        }
+
+    def get_sites(self, database=None):
+        self.calls += 1
+        return [
+            {
+                'id': site,
+                'activity': site % self.activities + 1,
+                'partner': {
+                    'id': site % self.partners,
+                    'name': 'Partner {}'.format(site % self.partners),
+                },
+                'location': {
+                    'id': site,
+                    'code': 'P{:06d}'.format(site),
+                    'name': 'Location {}'.format(site),
+                    'longitude': 35.5,
+                    'latitude': 33.9,
+                },
+                'attributes': [(site % self.activities + 1) * 10 + site % 3],
+            }
+            for site in range(1, self.sites + 1)
+        ]
+
+    def get_cube(self, activity_ids, month=''):
+        self.calls += 1
+        activity_ids = set(activity_ids)
+        year, month = [int(part) for part in month.split('-')]
+        rows = []
+        for site in range(1, self.sites + 1):
+            if site % self.activities + 1 not in activity_ids:
+                continue
+            for indicator in range(self.indicators):
+                rows.append({
+                    'key': {
+                        'Site': {'id': site},
+                        'Date': {'year': year, 'month': month},
+                        'Indicator': {
+                            'id': indicator,
+                            'label': 'Indicator {}'.format(indicator),
+                        },
+                    },
+                    'sum': (site * indicator + month + self.seed) % 100 + 1,
+                })
+        return rows
+
+
+def megabytes(size):
+    # peaks are not measured where /proc/self/clear_refs is unavailable
+    return size / 1024.0 / 1024 if size else float('nan')
+
+
+def report(run):
+    print '{:<30} {:>9} {:>9} {:>10} {:>10} {:>6} {:>8}'.format(
+        'stage', 'seconds', 'rows', 'rows/sec', 'mongo', 'http', 'peak MB')
+    for stage in run.stages:
+        print '{:<30} {:>9.2f} {:>9} {:>10.0f} {:>10} {:>6} {:>8.1f}'.format(
+            stage.name,
+            stage.seconds,
+            stage.rows,
+            stage.rows / stage.seconds if stage.seconds else 0,
+            stage.mongo_calls,
+            stage.http_calls,
+            megabytes(stage.peak_memory)
+        )
+    print '{:<30} {:>9.2f} {:>9} {:>10} {:>10} {:>6} {:>8.1f}'.format(
+        run.command, run.seconds, '', '', run.mongo_calls,
+        run.http_calls, megabytes(run.peak_memory))
+
+
+@bench.option('--sites', dest='sites', default=1000)
+@bench.option('--indicators', dest='indicators', default=20)
+@bench.option('--months', dest='months', default=3)
+@bench.option('--activities', dest='activities', default=10)
+@bench.option('--db-id', dest='db_id', default='bench')
+@bench.option('--seed', dest='seed', default=0)
+@bench.option('--batch-size', dest='batch_size', default=1000)
+@bench.option('--chunk-size', dest='chunk_size', default=50)
+def synthetic(
+        sites=1000,
+        indicators=20,
+        months=3,
+        activities=10,
+        db_id='bench',
+        seed=0,
+        batch_size=1000,
+        chunk_size=50
+):
+    """
+    Imports a synthetic database for a number of months,
+    run it twice to measure the unchanged path
+    """
+    client = SyntheticClient(sites, indicators, activities, seed=seed)
+    # the cache invalidation needs redis and clears the exports bucket,
+    # keep the benchmark to the local mongod
+    manage.clear_caches = lambda metrics=None: None
+
+    # the last few months up to the current one
+    year, month = [int(part) for part in time.strftime('%Y-%m').split('-')]
+    dates = []
+    for i in range(int(months)):
+        dates.insert(0, '{}-{:02d}'.format(year, month))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+
+    with RunMetrics('bench_synthetic', sites=sites, months=months) as metrics:
+        locations = LocationCache(metrics=metrics)
+        database = prepare_database(client, db_id, locations, metrics)
+        for date in dates:
+            with Stage('import_month {}'.format(date), metrics) as stage:
+                writer = import_month(
+                    client, database, date, locations, batch_size, chunk_size,
+                    metrics)
+                stage.rows = writer.created + writer.updated + writer.unchanged
+
+    report(metrics.run)
+
+
+@bench.command
+def levels(fixtures='fixtures/levels', record=False, country_code='LB'):
+    """
+    Runs update_levels against recorded ActivityInfo responses
+    """
+    with HttpRecorder(fixtures, record):
+        manage.update_levels(country_code)
+    report(ImportRun.objects(command='update_levels').first())
+
+
+@bench.command
+def sites(
+        fixtures='fixtures/sites',
+        record=False,
+        api_key='',
+        domain='',
+        username='',
+        password='',
+        list_name='',
+        site_type='',
+        name_col='',
+        code_col='',
+        target_list=''
+):
+    """
+    Runs update_sites against recorded CartoDB and ActivityInfo responses
+    """
+    # keep slack out of the recordings
+    manage.send_message = lambda message, metrics=None: None
+    with HttpRecorder(fixtures, record):
+        manage.update_sites(
+            api_key=api_key,
+            domain=domain,
+            username=username,
+            password=password,
+            list_name=list_name,
+            site_type=site_type,
+            name_col=name_col,
+            code_col=code_col,
+            target_list=target_list,
+            workers=1,
+            # replays don't need to respect the AI rate limit
+            rate=5 if record else 1000000
+        )
+    report(ImportRun.objects(command='update_sites').first())
+
+
+if __name__ == "__main__":
+    bench.run()
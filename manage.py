@@ -4,12 +4,19 @@ __author__ = 'jcranwellward'
 
 import logging
 import os, re
+import time
+import threading
 import random
+import hashlib
 import datetime
 import requests
 import json
 import pprint
 
+from itertools import count, izip
+from collections import Counter, OrderedDict
+from multiprocessing.pool import ThreadPool
+
 from flask.ext.script import (
     Command,
     Manager,
@@ -17,54 +24,945 @@ from flask.ext.script import (
     Server
 )
 
+from bson import ObjectId
 from pymongo import MongoClient
 from activtyinfo_client import ActivityInfoClient
 from cartodb import CartoDBAPIKey, CartoDBException
 
-from aggregator import app, Report, Attribute
+from aggregator import (
+    app,
+    SEARCH_FIELDS,
+    Report,
+    Attribute,
+    ImportRun,
+    RunStage,
+    aggregate,
+    bump_generation,
+    clear_export_cache,
+    search_keys
+)
 
 manager = Manager(app)
 
 ai = MongoClient(
     os.environ.get('MONGODB_URL', 'mongodb://localhost:27017'))['ai-aggregator']
 
+# AI admin level ids for governorate, district and cadastral
+ADMIN_LEVELS = os.environ.get('AI_ADMIN_LEVELS', '1370,1521,1522')
+
+# monthly rollups of report values by database, partner and indicator
+# for each admin level, collection: (code field, name field)
+ROLLUPS = {
+    'rollup_governorate': ('gov_code', 'governorate'),
+    'rollup_district': ('district_code', 'district'),
+}
+
+
+def send_message(message, metrics=None):
+    with Stage('notify', metrics) as stage:
+        stage.http_calls = 1
+        requests.post(
+            os.environ.get('SLACK_WEBHOOK'),
+            data=json.dumps({'text': message})
+        )
+
+
+class PeakMemory(object):
+    """
+    Measures the peak resident memory of each run and stage. Linux keeps
+    one high water mark per process, so before it is reset for a new run
+    or stage the mark so far is handed to every run and stage still open.
+    Peaks are None where /proc/self/clear_refs can't be written.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.peaks = {}
+        self.keys = count()
+
+    def collect(self):
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    # in kilobytes
+                    mark = int(line.split()[1]) * 1024
+                    break
+            else:
+                return
+        for key, peak in self.peaks.items():
+            self.peaks[key] = max(peak, mark)
+
+    def start(self):
+        with self.lock:
+            try:
+                self.collect()
+                # resets the high water mark to the current resident memory
+                with open('/proc/self/clear_refs', 'w') as clear_refs:
+                    clear_refs.write('5')
+            except (IOError, OSError):
+                return None
+            key = next(self.keys)
+            self.peaks[key] = 0
+            return key
+
+    def stop(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            try:
+                self.collect()
+            except (IOError, OSError):
+                pass
+            return self.peaks.pop(key) or None
+
+
+peak_memory = PeakMemory()
+
+
+class Stage(object):
+    """
+    Times a stage of a run and records it in the run's metrics, if any.
+    The code in the stage counts the rows it handles and the mongo and
+    http calls it makes, stages enclosing others only count rows.
+    Calls to redis are not counted.
+    """
+
+    def __init__(self, name, metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self.rows = 0
+        self.mongo_calls = 0
+        self.http_calls = 0
+
+    def __enter__(self):
+        self.started = time.time()
+        if self.metrics is not None:
+            self.memory = peak_memory.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.metrics is not None:
+            self.metrics.add(
+                self.name,
+                peak_memory.stop(self.memory),
+                seconds=time.time() - self.started,
+                rows=self.rows,
+                mongo_calls=self.mongo_calls,
+                http_calls=self.http_calls,
+            )
+
+
+class RunMetrics(object):
+    """
+    Records a command run and its stages in the runs collection,
+    stages run more than once or from several threads add up
+    and keep the highest of their peaks
+    """
+
+    def __init__(self, command, **args):
+        self.command = command
+        self.args = args
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, name, memory=None, **values):
+        with self.lock:
+            stage = self.stages.setdefault(name, RunStage(
+                name=name, seconds=0, rows=0, mongo_calls=0, http_calls=0))
+            for field, value in values.items():
+                setattr(stage, field, getattr(stage, field) + value)
+            stage.peak_memory = max(stage.peak_memory, memory)
+
+    def __enter__(self):
+        self.started = time.time()
+        self.memory = peak_memory.start()
+        self.run = ImportRun(
+            command=self.command,
+            args=self.args,
+            status='running',
+            started=datetime.datetime.utcnow()
+        )
+        self.run.save()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stages = self.stages.values()
+        self.run.status = 'failed' if exc_type else 'success'
+        self.run.error = repr(exc_value) if exc_type else None
+        self.run.finished = datetime.datetime.utcnow()
+        self.run.seconds = time.time() - self.started
+        self.run.mongo_calls = sum(stage.mongo_calls for stage in stages)
+        self.run.http_calls = sum(stage.http_calls for stage in stages)
+        self.run.peak_memory = peak_memory.stop(self.memory)
+        self.run.stages = stages
+        self.run.save()
+
+
+def fingerprint(doc):
+    """
+    Hashes the stored fields of a report, without its id and attributes
+    """
+    return hashlib.md5(
+        json.dumps(doc, sort_keys=True, default=unicode)
+    ).hexdigest()
+
+
+class ReportWriter(object):
+    """
+    Collects reports and writes them to mongo in batches
+    of unordered upserts keyed on the report natural key.
+    Reports whose fingerprint matches the stored one are skipped.
+    """
+    key_fields = (
+        'db_name',
+        'date',
+        'site_id',
+        'activity_id',
+        'partner_id',
+        'indicator_id',
+    )
+
+    def __init__(self, batch_size=1000, metrics=None):
+        self.collection = Report._get_collection()
+        self.batch_size = int(batch_size)
+        self.metrics = metrics
+        # to_mongo leaves out fields that are None, these are
+        # unset so values removed in AI don't linger
+        self.fields = [
+            Report._fields[name].db_field for name in Report._fields_ordered
+            if name not in ('id', 'attributes') + self.key_fields
+        ]
+        self.pending = []
+        self.fingerprints = {}
+        self.seen = set()
+        self.changed = set()
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+
+    def key(self, doc):
+        return tuple(doc[field] for field in self.key_fields)
+
+    def existing(self, db_name, date):
+        """
+        Loads the stored fingerprints for a database and month
+        the first time a report for them is added
+        """
+        if (db_name, date) not in self.fingerprints:
+            projection = dict((field, 1) for field in self.key_fields)
+            projection['fingerprint'] = 1
+            with Stage('load_fingerprints', self.metrics) as stage:
+                stage.mongo_calls = 1
+                self.fingerprints[(db_name, date)] = dict(
+                    (self.key(doc), (doc['_id'], doc.get('fingerprint')))
+                    for doc in self.collection.find(
+                        {'db_name': db_name, 'date': date}, projection)
+                )
+                stage.rows = len(self.fingerprints[(db_name, date)])
+        return self.fingerprints[(db_name, date)]
+
+    def add(self, report):
+        # convert through mongoengine so values are stored as before
+        doc = report.to_mongo()
+        doc.pop('_id', None)
+        doc.pop('fingerprint', None)
+        attributes = doc.pop('attributes', [])
+        doc['fingerprint'] = fingerprint(doc)
+
+        key = self.key(doc)
+        self.seen.add(key)
+        stored = self.existing(doc['db_name'], doc['date']).get(key)
+        if stored and stored[1] == doc['fingerprint']:
+            self.unchanged += 1
+            return
+
+        self.changed.add((doc['db_name'], doc['date']))
+        self.pending.append((doc, attributes))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        with Stage('write', self.metrics) as stage:
+            bulk = self.collection.initialize_unordered_bulk_op()
+            for doc, attributes in self.pending:
+                key = dict((field, doc.pop(field)) for field in self.key_fields)
+                # attributes are only written when the report is first created
+                update = {
+                    '$set': doc,
+                    '$setOnInsert': {'attributes': attributes},
+                }
+                unset = dict(
+                    (field, '') for field in self.fields if field not in doc)
+                if unset:
+                    update['$unset'] = unset
+                bulk.find(key).upsert().update_one(update)
+            result = bulk.execute()
+            stage.rows = len(self.pending)
+            stage.mongo_calls = 1
+
+        self.created += result['nUpserted']
+        self.updated += result['nMatched']
+        self.pending = []
+
+    def delete_missing(self):
+        """
+        Removes stored reports for the months loaded in this run
+        whose cube cell was not in the run
+        """
+        self.flush()
+        missing = []
+        for month, existing in self.fingerprints.items():
+            for key, (_id, fingerprint) in existing.items():
+                if key not in self.seen:
+                    missing.append(_id)
+                    self.changed.add(month)
+        with Stage('delete', self.metrics) as stage:
+            for i in range(0, len(missing), self.batch_size):
+                self.collection.remove(
+                    {'_id': {'$in': missing[i:i + self.batch_size]}})
+                stage.mongo_calls += 1
+            stage.rows = len(missing)
+        self.deleted += len(missing)
+
+
+class LocationCache(object):
+    """
+    Maps location ids to their (governorate, district, cadastral)
+    admin entities so each location is only read once per run.
+    """
+
+    def __init__(self, admin_levels=ADMIN_LEVELS, metrics=None):
+        self.admin_levels = admin_levels.split(',')
+        self.metrics = metrics
+        self.projection = dict(
+            ('adminEntities.{}'.format(level), 1)
+            for level in self.admin_levels
+        )
+        self.projection['id'] = 1
+        self.locations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def entities(self, location):
+        admin_entities = location.get('adminEntities', {}) if location else {}
+        return tuple(
+            admin_entities.get(level) for level in self.admin_levels
+        )
+
+    def preload(self, location_ids):
+        location_ids = set(location_ids) - set(self.locations)
+        if not location_ids:
+            return
+        # locations we don't have locally are cached as empty too
+        for location_id in location_ids:
+            self.locations[location_id] = self.entities(None)
+        with Stage('preload_locations', self.metrics) as stage:
+            stage.mongo_calls = 1
+            for location in ai.locations.find(
+                    {'id': {'$in': list(location_ids)}}, self.projection):
+                self.locations[location['id']] = self.entities(location)
+                stage.rows += 1
+
+    def get(self, location_id):
+        if location_id in self.locations:
+            self.hits += 1
+        else:
+            self.misses += 1
+            with Stage('get_location', self.metrics) as stage:
+                stage.rows = stage.mongo_calls = 1
+                self.locations[location_id] = self.entities(
+                    ai.locations.find_one({'id': location_id}, self.projection)
+                )
+        return self.locations[location_id]
+
+
+class AttributeIndex(object):
+    """
+    Maps attribute ids to (group name, attribute name, mandatory)
+    so site attributes can be resolved without querying attributeGroups.
+    """
+
+    def __init__(self, groups):
+        self.attributes = {}
+        for group_pos, group in enumerate(groups):
+            for attr_pos, attribute in enumerate(group.get('attributes', [])):
+                self.attributes.setdefault(attribute['id'], (
+                    (group_pos, attr_pos),
+                    group['id'],
+                    (group['name'], attribute['name'], group.get('mandatory')),
+                ))
+
+    def resolve(self, attribute_ids):
+        """
+        Returns the first matching attribute of each group,
+        the same as the 'attributes.$' projection did
+        """
+        matches = sorted(
+            (self.attributes[attr_id] for attr_id in set(attribute_ids)
+             if attr_id in self.attributes),
+            key=lambda match: match[0]
+        )
+        groups = set()
+        resolved = []
+        for position, group_id, attribute in matches:
+            if group_id not in groups:
+                groups.add(group_id)
+                resolved.append(attribute)
+        return resolved
+
+
+class LocationUploader(object):
+    """
+    Sends CreateLocation commands from a bounded pool of threads at no
+    more than rate requests per second, retrying with exponential backoff.
+    CreateLocation is not idempotent, so after a 5xx or an error once the
+    request may have been sent, the location type is checked for the
+    p-code before it is sent again.
+    """
+    success_codes = (requests.codes.ok, requests.codes.no_content)
+
+    def __init__(self, client, workers=4, rate=5, retries=5, backoff=1):
+        self.client = client
+        self.workers = int(workers)
+        self.interval = 1.0 / float(rate)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+        self.calls = 0
+        self.created = []
+        self.failed = []
+
+    def wait(self):
+        # reserve the next free slot, then sleep until it comes round,
+        # every call to AI waits for one so they are counted here
+        with self.lock:
+            now = time.time()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+            self.calls += 1
+        time.sleep(slot - now)
+
+    def exists(self, payload):
+        """
+        Returns whether the location's p-code is in AI,
+        or None when that can't be told
+        """
+        self.wait()
+        try:
+            locations = self.client.get_locations(payload['locationTypeId'])
+        except requests.RequestException:
+            return None
+        return any(
+            location.get('code') == payload['axe'] for location in locations)
+
+    def create(self, payload):
+        uncertain = False
+        for attempt in range(self.retries + 1):
+            if uncertain:
+                exists = self.exists(payload)
+                if exists:
+                    return payload, True
+                if exists is None:
+                    time.sleep(self.backoff * 2 ** attempt)
+                    continue
+                uncertain = False
+
+            self.wait()
+            try:
+                status = self.client.call_command(
+                    'CreateLocation', **payload).status_code
+            except requests.exceptions.ConnectTimeout:
+                # the request never reached the server
+                status = None
+            except requests.RequestException:
+                status = None
+                uncertain = True
+            if status in self.success_codes:
+                return payload, True
+            if status is not None and status < 500 \
+                    and status != requests.codes.too_many_requests:
+                break
+            if status is not None and status != requests.codes.too_many_requests:
+                # a 5xx may come after the location was created
+                uncertain = True
+            time.sleep(self.backoff * 2 ** attempt)
+        return payload, False
+
+    def upload(self, payloads):
+        pool = ThreadPool(self.workers)
+        try:
+            for payload, success in pool.imap_unordered(self.create, payloads):
+                if success:
+                    self.created.append(payload)
+                    print 'Updated {}'.format(payload['name'])
+                else:
+                    self.failed.append(payload)
+                    print 'Error for {}'.format(payload['name'])
+        finally:
+            pool.close()
+            pool.join()
+        return self.created, self.failed
+
+
+def bulk_upsert(collection, docs, batch_size=1000):
+    """
+    Replaces documents by their AI id in unordered batches,
+    returns the number of documents written
+    """
+    written = 0
+    bulk = None
+    for doc in docs:
+        if bulk is None:
+            bulk = collection.initialize_unordered_bulk_op()
+        bulk.find({'_id': doc['id']}).upsert().replace_one(doc)
+        written += 1
+        if written % int(batch_size) == 0:
+            bulk.execute()
+            bulk = None
+    if bulk is not None:
+        bulk.execute()
+    return written
+
+
+def batches(count, batch_size):
+    return (count + int(batch_size) - 1) // int(batch_size)
+
+
+def carto_rows(carto_client, table, columns, page_size=1000, metrics=None):
+    """
+    Yields the given columns of a CartoDB table a page at a time in
+    cartodb_id order, fetching the next page while this one is processed
+    """
+    query = 'select cartodb_id, {} from {} where cartodb_id > {{}} ' \
+            'order by cartodb_id limit {}'.format(
+                ', '.join(columns), table, int(page_size))
+
+    def fetch(last_id):
+        with Stage('carto_rows', metrics) as stage:
+            stage.http_calls = 1
+            rows = carto_client.sql(query.format(last_id))['rows']
+            stage.rows = len(rows)
+        return rows
+
+    pool = ThreadPool(1)
+    try:
+        pending = pool.apply_async(fetch, (0,))
+        while pending:
+            rows = pending.get()
+            pending = None
+            if len(rows) == int(page_size):
+                pending = pool.apply_async(fetch, (rows[-1]['cartodb_id'],))
+            for row in rows:
+                yield row
+    finally:
+        pool.close()
+        pool.join()
+
+
+def admin_hierarchy():
+    """
+    Maps cadastral codes to their (cadastral, caza, governorate) entities,
+    codes that don't resolve to all three levels are left out
+    """
+    projection = {'id': 1, 'code': 1, 'parentId': 1, 'levelId': 1}
+    govs = dict(
+        (gov['id'], gov) for gov in ai['Governorate'].find({}, projection))
+    cazas = dict(
+        (caz['id'], caz) for caz in ai['Caza'].find({}, projection))
+
+    hierarchy = {}
+    for cad in ai['Cadastral Area'].find({}, projection):
+        caz = cazas.get(cad.get('parentId'))
+        gov = govs.get(caz.get('parentId')) if caz else None
+        if gov:
+            hierarchy.setdefault(str(cad.get('code')), (cad, caz, gov))
+    return hierarchy
+
+
+def write_dry_run(output, payloads, bad_codes=()):
+    """
+    Writes the locations a run would create to a json file
+    """
+    names = Counter(payload['name'][0:40] for payload in payloads)
+    with open(output, 'w') as plan:
+        json.dump({
+            'new_p_codes': [payload['axe'] for payload in payloads],
+            'payloads': payloads,
+            'bad_codes': list(bad_codes),
+            'duplicate_names': sorted(
+                name for name, count in names.items() if count > 1),
+        }, plan, indent=2, default=unicode)
+    print 'Dry run: {} locations to create, {} bad codes, written to {}'.format(
+        len(payloads), len(bad_codes), output)
+
+
+def site_fields(site):
+    """
+    Keeps only the site fields the importer reads
+    """
+    kept = dict(
+        (field, site[field]) for field in ('id', 'activity', 'comments', 'attributes')
+        if field in site
+    )
+    kept['partner'] = {
+        'id': site['partner']['id'],
+        'name': site['partner']['name'],
+    }
+    kept['location'] = dict(
+        (field, site['location'][field])
+        for field in ('id', 'code', 'name', 'longitude', 'latitude')
+        if field in site['location']
+    )
+    return kept
+
+
+def cube_rows(client, activity_ids, date, chunk_size=50, metrics=None):
+    """
+    Yields the cube rows for the activities, requesting
+    them a chunk of activities at a time
+    """
+    activity_ids = list(activity_ids)
+    for i in range(0, len(activity_ids), int(chunk_size)):
+        with Stage('get_cube', metrics) as stage:
+            stage.http_calls = 1
+            rows = client.get_cube(
+                activity_ids[i:i + int(chunk_size)], month=date)
+            stage.rows = len(rows)
+        for row in rows:
+            yield row
+
+
+def update_rollups(db_name, dates=None, batch_size=1000, metrics=None):
+    """
+    Recomputes the monthly rollups of a database from its reports,
+    for the given months or all of them, one month at a time
+    """
+    if not dates:
+        with Stage('rollups', metrics) as stage:
+            dates = Report._get_collection().find(
+                {'db_name': db_name}).distinct('date')
+            stage.mongo_calls = 1
+
+    for collection, (code, name) in ROLLUPS.items():
+        rollups = ai[collection]
+        with Stage('rollup_indexes', metrics) as stage:
+            rollups.ensure_index([('db_name', 1), ('date', 1)], background=True)
+            for field in (code, 'partner_id', 'indicator_id'):
+                rollups.ensure_index(field, background=True)
+            stage.mongo_calls = 4
+
+        for date in sorted(dates):
+            with Stage('rollups', metrics) as stage:
+                # cells written in this pass carry its generation,
+                # any other cell for the month no longer has reports
+                generation = ObjectId()
+                result = aggregate(Report._get_collection(), [
+                    {'$match': {'db_name': db_name, 'date': date}},
+                    {'$group': {
+                        '_id': {
+                            'date': '$date',
+                            'db_name': '$db_name',
+                            code: '$' + code,
+                            'partner_id': '$partner_id',
+                            'indicator_id': '$indicator_id',
+                        },
+                        name: {'$first': '$' + name},
+                        'partner_name': {'$first': '$partner_name'},
+                        'indicator_name': {'$first': '$indicator_name'},
+                        'value': {'$sum': '$value'},
+                        'reports': {'$sum': 1},
+                    }},
+                ])
+
+                bulk = None
+                written = 0
+                for row in result:
+                    if bulk is None:
+                        bulk = rollups.initialize_unordered_bulk_op()
+                    doc = dict(row, generation=generation, **row['_id'])
+                    bulk.find({'_id': row['_id']}).upsert().replace_one(doc)
+                    written += 1
+                    if written % int(batch_size) == 0:
+                        bulk.execute()
+                        stage.mongo_calls += 1
+                        bulk = None
+                if bulk is not None:
+                    bulk.execute()
+                    stage.mongo_calls += 1
+
+                rollups.remove({
+                    'db_name': db_name,
+                    'date': date,
+                    'generation': {'$ne': generation},
+                })
+                # the aggregate and the remove
+                stage.rows = written
+                stage.mongo_calls += 2
+
+
+@manager.command
+def rebuild_rollups():
+    """
+    Rebuilds the monthly rollup collections from scratch
+    """
+    for collection in ROLLUPS:
+        ai[collection].drop()
+    for db_name in Report._get_collection().distinct('db_name'):
+        print 'Rebuilding rollups for {}'.format(db_name.encode('UTF-8'))
+        update_rollups(db_name)
+
+
+def clear_caches(metrics=None):
+    """
+    Invalidates cached exports and responses after reports change
+    """
+    with Stage('clear_caches', metrics) as stage:
+        # the find, then a files and a chunks remove per export
+        stage.mongo_calls = 1 + 2 * clear_export_cache()
+        bump_generation()
+
+
+def rewrite_reports(match, convert, batch_size=1000, metrics=None):
+    """
+    Sets the fields returned by convert on the stored reports matching
+    match, in batches of _id order, and refreshes their fingerprints.
+    Rewritten reports must stop matching, so running it again resumes
+    where an interrupted run stopped. Reports convert returns nothing
+    for are left as they are. Returns the number rewritten.
+    """
+    collection = Report._get_collection()
+    with Stage('count', metrics) as stage:
+        total = collection.find(match).count()
+        stage.mongo_calls = 1
+    print 'Reports to rewrite: {}'.format(total)
+
+    seen = 0
+    done = 0
+    last_id = None
+    started = time.time()
+    while True:
+        query = dict(match)
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        docs = list(
+            collection.find(query).sort('_id', 1).limit(int(batch_size)))
+        if not docs:
+            break
+
+        with Stage('write', metrics) as stage:
+            bulk = collection.initialize_unordered_bulk_op()
+            writes = 0
+            for doc in docs:
+                update = convert(doc)
+                if not update:
+                    continue
+                stored = dict(doc, **update)
+                for field in ('_id', 'attributes', 'fingerprint'):
+                    stored.pop(field, None)
+                # refresh the fingerprint so the next import
+                # does not rewrite every converted report
+                update['fingerprint'] = fingerprint(stored)
+                bulk.find({'_id': doc['_id']}).update_one({'$set': update})
+                writes += 1
+            # the find and the bulk write, an empty bulk can't be executed
+            stage.mongo_calls = 1
+            if writes:
+                bulk.execute()
+                stage.mongo_calls += 1
+            stage.rows = writes
+
+        last_id = docs[-1]['_id']
+        seen += len(docs)
+        done += writes
+        elapsed = time.time() - started
+        print 'Checked {} of {} reports, {} rewritten, {:.0f}/sec'.format(
+            seen, total, done, seen / elapsed if elapsed else 0)
+    return done
+
+
+@manager.command
+def backfill_search_keys(batch_size=1000):
+    """
+    Sets the search keys of reports imported before they existed,
+    running it again resumes where it stopped
+    """
+    with RunMetrics('backfill_search_keys') as metrics:
+        done = rewrite_reports(
+            {'search_keys': {'$exists': False}},
+            lambda doc: {
+                'search_keys': search_keys(
+                    doc.get(field) for field in SEARCH_FIELDS)
+            },
+            batch_size,
+            metrics
+        )
+        print 'Done, {} reports updated'.format(done)
+        if done:
+            # cached searches left these reports out
+            clear_caches(metrics)
 
-def send_message(message):
-    requests.post(
-        os.environ.get('SLACK_WEBHOOK'),
-        data=json.dumps({'text': message})
+
+@manager.command
+def indexes(action='verify'):
+    """
+    Builds, verifies or drops the indexes declared on Report.
+    Verify also lists declared single field indexes that have never been used.
+    """
+    def index_key(fields):
+        # mongo keys every text index on its _fts/_ftsx fields
+        if any(direction == 'text' for field, direction in fields):
+            return ('_fts', 'text'), ('_ftsx', 1)
+        return tuple(fields)
+
+    collection = Report._get_collection()
+    existing = dict(
+        (index_key(info['key']), name)
+        for name, info in collection.index_information().items()
     )
 
+    for spec in Report._meta['index_specs']:
+        key = index_key(spec['fields'])
+        options = dict(
+            (k, v) for k, v in spec.items() if k not in ('fields', 'cls')
+        )
+        if action == 'build':
+            print 'Building index {}'.format(spec['fields'])
+            collection.ensure_index(spec['fields'], background=True, **options)
+        elif action == 'drop':
+            if key in existing:
+                print 'Dropping index {}'.format(existing[key])
+                collection.drop_index(existing[key])
+        elif key not in existing:
+            print 'Missing index {}'.format(key)
+
+    if action != 'verify':
+        return
+
+    declared = [index_key(spec['fields']) for spec in Report._meta['index_specs']]
+    for key, name in existing.items():
+        if name != '_id_' and key not in declared:
+            print 'Undeclared index {}'.format(name)
+
+    # usage counters are reset when mongod restarts
+    usage = dict(
+        (stat['name'], stat['accesses']['ops'])
+        for stat in aggregate(collection, [{'$indexStats': {}}])
+    )
+    for key in declared:
+        name = existing.get(key)
+        if len(key) == 1 and name in usage and not usage[name]:
+            print 'Unused index {}'.format(name)
+
 
 @manager.command
-def update_levels(country_code='LB'):
+def migrate_values(batch_size=1000):
+    """
+    Converts report values and coordinates stored as strings by the old
+    DecimalField to doubles, in batches of _id order. Converted reports
+    no longer match, so running it again resumes where it stopped.
+    Strings that aren't numbers are left unchanged and reported.
+    """
+    fields = ('value', 'location_x', 'location_y')
+    # type 2 is string
+    match = {'$or': [{field: {'$type': 2}} for field in fields]}
+    unparseable = []
+
+    def convert(doc):
+        update = {}
+        for field in fields:
+            value = doc.get(field)
+            if not isinstance(value, basestring):
+                continue
+            try:
+                update[field] = float(value)
+            except ValueError:
+                print 'Report {} {}: {!r} is not a number, left as is'.format(
+                    doc['_id'], field, value)
+                unparseable.append((doc['_id'], field))
+        return update
+
+    with RunMetrics('migrate_values') as metrics:
+        done = rewrite_reports(match, convert, batch_size, metrics)
+        print 'Done, {} reports converted'.format(done)
+        if done:
+            # cached exports and payloads still have the strings
+            clear_caches(metrics)
+        if unparseable:
+            print '{} values could not be converted and were left as strings'.format(
+                len(unparseable))
+
+
+@manager.command
+def update_levels(country_code='LB', workers=4, batch_size=1000):
     """
     Updates local admin level lookup tables from AI.
     These lookup tables are used when creating sites for AI.
     """
+    with RunMetrics('update_levels', country_code=country_code) as metrics:
+        client = ActivityInfoClient()
+        pool = ThreadPool(int(workers))
 
-    client = ActivityInfoClient()
+        def fetch(name, func, id):
+            with Stage(name, metrics) as stage:
+                stage.http_calls = 1
+                results = func(id)
+                stage.rows = len(results)
+            return results
 
-    for level in client.get_admin_levels(country_code):
-        entities = client.get_entities(level['id'])
-        for entity in entities:
-            ai[level['name']].update(
-                {'_id': entity['id']}, entity, upsert=True)
-            print 'Updated entity {}: {}'.format(
-                level['name'], entity['name'].encode('UTF-8')
-            )
+        try:
+            with Stage('get_admin_levels', metrics) as stage:
+                stage.http_calls = 2
+                levels = client.get_admin_levels(country_code)
+                site_types = client.get_location_types(country_code)
+            # all fetches are queued up front, each result is
+            # written as soon as it and the ones before it arrive
+            entities = pool.imap(
+                lambda level: fetch(
+                    'get_entities', client.get_entities, level['id']),
+                levels)
+            locations = pool.imap(
+                lambda site_type: fetch(
+                    'get_locations', client.get_locations, site_type['id']),
+                site_types)
 
-    for site_type in client.get_location_types(country_code):
-        locations = client.get_locations(site_type['id'])
-        for location in locations:
-            ai.locations.update(
-                {'_id': location['id']}, location, upsert=True)
-            print 'Updated {}: {}'.format(
-                site_type['name'].encode('UTF-8'), location['name'].encode('UTF-8')
-            )
+            for level, level_entities in izip(levels, entities):
+                with Stage('write', metrics) as stage:
+                    stage.rows = bulk_upsert(
+                        ai[level['name']], level_entities, batch_size)
+                    stage.mongo_calls = batches(stage.rows, batch_size)
+                print 'Updated {} entities: {}'.format(level['name'], stage.rows)
 
+            for site_type, type_locations in izip(site_types, locations):
+                with Stage('write', metrics) as stage:
+                    stage.rows = bulk_upsert(
+                        ai.locations, type_locations, batch_size)
+                    stage.mongo_calls = batches(stage.rows, batch_size)
+                print 'Updated {} locations: {}'.format(
+                    site_type['name'].encode('UTF-8'), stage.rows)
+        finally:
+            pool.close()
+            pool.join()
 
-@manager.command
+
+@manager.option('-a', '--api_key', dest='api_key', default='')
+@manager.option('-d', '--domain', dest='domain', default='')
+@manager.option('-u', '--username', dest='username', default='')
+@manager.option('-p', '--password', dest='password', default='')
+@manager.option('-l', '--list_name', dest='list_name', default='')
+@manager.option('-s', '--site_type', dest='site_type', default='')
+@manager.option('-n', '--name_col', dest='name_col', default='')
+@manager.option('-c', '--code_col', dest='code_col', default='')
+@manager.option('-t', '--target_list', dest='target_list', default='')
+@manager.option('-w', '--workers', dest='workers', default=4)
+@manager.option('-r', '--rate', dest='rate', default=5)
+@manager.option('--page-size', dest='page_size', default=1000)
+@manager.option('--dry-run', dest='dry_run', action='store_true', default=False)
+@manager.option('-o', '--output', dest='output', default='')
 def update_sites(
         api_key='',
         domain='',
@@ -74,68 +972,102 @@ def update_sites(
         site_type='',
         name_col='',
         code_col='',
-        target_list=''
+        target_list='',
+        workers=4,
+        rate=5,
+        page_size=1000,
+        dry_run=False,
+        output=''
 ):
-    carto_client = CartoDBAPIKey(api_key, domain)
-
-    ai_client = ActivityInfoClient(username, password)
+    with RunMetrics('update_sites', list_name=list_name, dry_run=dry_run) as metrics:
+        carto_client = CartoDBAPIKey(api_key, domain)
 
-    # create an index of sites by p_code
-    existing = dict(
-        (site['code'], dict(site, index=i))
-        for (i, site) in enumerate(
-            ai_client.get_locations(target_list)
-        ) if 'code' in site
-    )
+        ai_client = ActivityInfoClient(username, password)
 
-    sites = carto_client.sql(
-        'select * from {}'.format(list_name)
-    )
-    send_message('Starting upload of {}'.format(list_name))
-    bad_codes = []
-    updated_sites = 0
-    for row in sites['rows']:
-        p_code = str(row[code_col]).strip()
-        site_name = row[name_col].encode('UTF-8')
-        cad = ai['Cadastral Area'].find_one({'code': str(row['cad_code'])})
-        if cad is None:
-            bad_codes.append(row['cad_code'])
-            continue
-        caz = ai['Caza'].find_one({'id': cad['parentId']})
-        gov = ai['Governorate'].find_one({'id': caz['parentId']})
-
-        if p_code not in existing and site_name:
-
-            payload = dict(
-                id=int(random.getrandbits(31)),
-                locationTypeId=int(target_list),
-                name='{}: {}'.format(site_type, site_name)[0:40],
-                axe='{}'.format(p_code),
-                latitude=row['latitude'],
-                longitude=row['longitude'],
-                workflowstatusid='validated'
+        # create an index of sites by p_code
+        with Stage('get_locations', metrics) as stage:
+            stage.http_calls = 1
+            existing = dict(
+                (site['code'], dict(site, index=i))
+                for (i, site) in enumerate(
+                    ai_client.get_locations(target_list)
+                ) if 'code' in site
             )
-            payload['E{}'.format(gov['levelId'])] = gov['id']
-            payload['E{}'.format(caz['levelId'])] = caz['id']
-            payload['E{}'.format(cad['levelId'])] = cad['id']
-
-            response = ai_client.call_command('CreateLocation', **payload)
-            if response.status_code == requests.codes.no_content:
-                updated_sites += 1
-                print 'Updated {}'.format(payload['name'])
-            else:
-                print 'Error for {}'.format(payload['name'])
+            stage.rows = len(existing)
+
+        sites = carto_rows(
+            carto_client,
+            list_name,
+            [code_col, name_col, 'cad_code', 'latitude', 'longitude'],
+            page_size,
+            metrics
+        )
+        if not dry_run:
+            send_message('Starting upload of {}'.format(list_name), metrics)
+        with Stage('admin_hierarchy', metrics) as stage:
+            hierarchy = admin_hierarchy()
+            stage.rows = len(hierarchy)
+            stage.mongo_calls = 3
+        bad_codes = []
+        payloads = []
+        for row in sites:
+            p_code = str(row[code_col]).strip()
+            site_name = row[name_col].encode('UTF-8')
+            if str(row['cad_code']) not in hierarchy:
+                bad_codes.append(row['cad_code'])
+                continue
+            cad, caz, gov = hierarchy[str(row['cad_code'])]
+
+            if p_code not in existing and site_name:
 
-    print 'Bad codes: {}'.format(bad_codes)
-    print 'Updated sites: {}'.format(updated_sites)
-    send_message('Updated {} sites'.format(updated_sites))
+                payload = dict(
+                    id=int(random.getrandbits(31)),
+                    locationTypeId=int(target_list),
+                    name='{}: {}'.format(site_type, site_name)[0:40],
+                    axe='{}'.format(p_code),
+                    latitude=row['latitude'],
+                    longitude=row['longitude'],
+                    workflowstatusid='validated'
+                )
+                payload['E{}'.format(gov['levelId'])] = gov['id']
+                payload['E{}'.format(caz['levelId'])] = caz['id']
+                payload['E{}'.format(cad['levelId'])] = cad['id']
+                payloads.append(payload)
 
+        if dry_run:
+            write_dry_run(
+                output or '{}_dry_run.json'.format(list_name), payloads, bad_codes)
+            return
 
-@manager.command
-def update_ai_locations(type_id, username='', password=''):
+        with Stage('upload', metrics) as stage:
+            uploader = LocationUploader(ai_client, workers, rate)
+            created, failed = uploader.upload(payloads)
+            stage.rows = len(payloads)
+            stage.http_calls = uploader.calls
+
+        print 'Bad codes: {}'.format(bad_codes)
+        print 'Updated sites: {}'.format(len(created))
+        print 'Failed sites: {}'.format([failure['name'] for failure in failed])
+        send_message(
+            'Updated {} sites, {} failed'.format(len(created), len(failed)),
+            metrics)
+
+
+@manager.option('type_id')
+@manager.option('-u', '--username', dest='username', default='')
+@manager.option('-p', '--password', dest='password', default='')
+@manager.option('--dry-run', dest='dry_run', action='store_true', default=False)
+@manager.option('-o', '--output', dest='output', default='')
+def update_ai_locations(
+        type_id,
+        username='',
+        password='',
+        dry_run=False,
+        output=''
+):
     client = ActivityInfoClient(username, password)
 
-    updated_location = 0
+    payloads = []
     for location in ai.locations.find({'ai_name': {'$regex': 'PG'}}):
 
         payload = {
@@ -149,55 +1081,69 @@ def update_ai_locations(type_id, username='', password=''):
         }
         for id, level in location['adminEntities'].items():
             payload['E{}'.format(id)] = level['id']
+        payloads.append(payload)
+
+    if dry_run:
+        write_dry_run(output or '{}_dry_run.json'.format(type_id), payloads)
+        return
 
+    updated_location = 0
+    for payload in payloads:
         response = client.call_command('CreateLocation', **payload)
         if response.status_code == requests.codes.ok:
             updated_location += 1
-            print 'Uploaded {}'.format(location['ai_name'].encode('UTF-8'))
+            print 'Uploaded {}'.format(payload['name'].encode('UTF-8'))
         else:
-            print 'Error for: {}'.format(location['ai_name'].encode('UTF-8'))
+            print 'Error for: {}'.format(payload['name'].encode('UTF-8'))
 
     print updated_location
 
 
-@manager.command
-def import_ai(dbs, username='', password='', date=''):
+def prepare_database(client, db_id, locations, metrics=None):
     """
-    Imports data from Activity Info
+    Stores a database and its attribute groups and returns what is needed
+    to import its cube: (db_info, sites, activities, attribute_index)
     """
-
-    db_ids = dbs.split(',')
-    client = ActivityInfoClient(username, password)
-
-    for db_id in db_ids:
-        reports_created = 0
+    with Stage('get_database', metrics) as stage:
+        stage.http_calls = 1
         db_info = client.get_database(db_id)
-        send_message('AI import started for database: {}'.format(db_info['name']))
 
+    with Stage('store_database', metrics) as stage:
         # 'store the whole database for future reference'
         db_info['_id'] = db_id
         ai.databases.update({'_id': db_id}, db_info, upsert=True)
 
         # 'split out all the attribute groups into a separate collection'
         attribs = ai.databases.aggregate([
+            {'$match': {'_id': db_id}},
             {'$project': {'groups': '$activities.attributeGroups'}},
             {'$unwind': '$groups'},
             {'$unwind': '$groups'},
             {'$group': {'_id': "$_id", 'groups': {'$push': '$groups'}}},
         ])
-        for attrib in attribs['result'][0]['groups']:
+        groups = attribs['result'][0]['groups'] if attribs['result'] else []
+        for attrib in groups:
             attrib['_id'] = attrib['id']
             ai.attributeGroups.update({'_id': attrib['id']}, attrib, upsert=True)
+        attribute_index = AttributeIndex(groups)
+        stage.rows = len(groups)
+        # the update, the aggregate and an update per group
+        stage.mongo_calls = 2 + len(groups)
 
-        # 'create an index of sites by id'
+    # 'create an index of sites by id'
+    with Stage('get_sites', metrics) as stage:
+        stage.http_calls = 1
         sites = dict(
-            (site['id'], dict(site, index=i))
-            for (i, site) in enumerate(
-                client.get_sites(database=db_id)
-            )
+            (site['id'], site_fields(site))
+            for site in client.get_sites(database=db_id)
         )
+        stage.rows = len(sites)
+    locations.preload(
+        site['location']['id'] for site in sites.values()
+    )
 
-        # 'create an index of activities by id'
+    # 'create an index of activities by id'
+    with Stage('activities', metrics) as stage:
         activities = dict(
             (activity['id'], dict(activity, index=i))
             for (i, activity) in enumerate(
@@ -214,75 +1160,261 @@ def import_ai(dbs, username='', password='', date=''):
                 ])['result']
             )
         )
+        stage.rows = len(activities)
+        stage.mongo_calls = 1
+
+    return db_info, sites, activities, attribute_index
+
+
+def import_month(
+        client,
+        database,
+        date,
+        locations,
+        batch_size=1000,
+        chunk_size=50,
+        metrics=None
+):
+    """
+    Imports one month of reports for a prepared database,
+    returns the writer with the month's counts
+    """
+    db_info, sites, activities, attribute_index = database
+    writer = ReportWriter(batch_size, metrics)
+    # load the stored reports of the month first so they are removed
+    # even when the cube has no rows for it, stored dates are not padded
+    year, month = date.split('-')
+    writer.existing(db_info['name'], '{}-{}'.format(int(year), int(month)))
 
-        # 'get all reports for these activities: {}'.format(activities.keys())
-        if not date:  # if no date provided get for the current month
-            date = datetime.date.today().strftime('%Y-%m')
-        send_message('Pulling reports for date: {}'.format(date))
+    forms = cube_rows(client, activities.keys(), date, chunk_size, metrics)
 
-        forms = client.get_cube(activities.keys(), month=date)
+    for indicator in forms:
 
-        # 'processing {} forms'.format(len(forms))
-        for indicator in forms:
+        site = sites[indicator['key']['Site']['id']]
+        attributes = []
+        if 'attributes' in site:
+            attributes = attribute_index.resolve(site['attributes'])
+        if indicator['sum']:
+            report = Report(
+                db_name=db_info['name'],
+                date='{}-{}'.format(
+                    indicator['key']['Date']['year'],
+                    indicator['key']['Date']['month'],
+                ),
+                site_id=site['id'],
+                activity_id=site['activity'],
+                partner_id=site['partner']['id'],
+                indicator_id=indicator['key']['Indicator']['id'],
+            )
+            activity = activities[report.activity_id]
+            report.value = indicator['sum']
+            report.category = activity['category']
+            report.activity = activity['name']
+            report.partner_name = site['partner']['name']
+            report.p_code = site['location']['code']
+            report.location_name = site['location']['name']
+            report.location_id = site['location']['id']
+            report.location_x = site['location'].get('longitude', None)
+            report.location_y = site['location'].get('latitude', None)
+            report.indicator_name = indicator['key']['Indicator']['label']
+            report.comments = site.get('comments', None)
 
-            site = sites[indicator['key']['Site']['id']]
-            attributes = []
-            if 'attributes' in site:
-                attributes = [
-                    attr for attr in ai.attributeGroups.find(
-                        {'attributes.id': {'$in': site['attributes']}},
-                        {'name': 1, 'mandatory': 1, "attributes.$": 1}
+            gov, district, cadastral = locations.get(report.location_id)
+            if gov:
+                report.gov_code = str(gov['id'])
+                report.governorate = gov['name']
+            if district:
+                report.district_code = str(district['id'])
+                report.district = district['name']
+            if cadastral:
+                report.cadastral_code = str(cadastral['id'])
+                report.cadastral = cadastral['name']
+            for group_name, attribute_name, mandatory in attributes:
+                report.attributes.append(
+                    Attribute(
+                        name=group_name,
+                        value=attribute_name
                     )
-                ]
-            if indicator['sum']:
-                report, created = Report.objects.get_or_create(
-                    db_name=db_info['name'],
-                    date='{}-{}'.format(
-                        indicator['key']['Date']['year'],
-                        indicator['key']['Date']['month'],
-                    ),
-                    site_id=site['id'],
-                    activity_id=site['activity'],
-                    partner_id=site['partner']['id'],
-                    indicator_id=indicator['key']['Indicator']['id'],
                 )
-                activity = activities[report.activity_id]
-                report.value = indicator['sum']
-                report.category = activity['category']
-                report.activity = activity['name']
-                report.partner_name = site['partner']['name']
-                report.p_code = site['location']['code']
-                report.location_name = site['location']['name']
-                report.location_id = site['location']['id']
-                report.location_x = site['location'].get('longitude', None)
-                report.location_y = site['location'].get('latitude', None)
-                report.indicator_name = indicator['key']['Indicator']['label']
-                report.comments = site.get('comments', None)
-
-                location = ai.locations.find_one({'id': report.location_id})
-                if location and 'adminEntities' in location:
-                    try:
-                        report.gov_code = str(location['adminEntities']['1370']['id'])
-                        report.governorate = location['adminEntities']['1370']['name']
-                        report.district_code = str(location['adminEntities']['1521']['id'])
-                        report.district = location['adminEntities']['1521']['name']
-                        report.cadastral_code = str(location['adminEntities']['1522']['id'])
-                        report.cadastral = location['adminEntities']['1522']['name']
-                    except Exception as exp:
-                        pass
-                if created:
-                    for a in attributes:
-                        report.attributes.append(
-                            Attribute(
-                                name=a['name'],
-                                value=a['attributes'][0]['name']
-                            )
+
+            report.set_search_keys()
+            writer.add(report)
+
+    writer.delete_missing()
+    if writer.changed:
+        update_rollups(
+            db_info['name'], set(month for name, month in writer.changed),
+            metrics=metrics)
+        clear_caches(metrics)
+    return writer
+
+
+def month_range(start, end):
+    """
+    Lists the months from start to end inclusive, as YYYY-MM
+    """
+    year, month = [int(part) for part in start.split('-')]
+    end_year, end_month = [int(part) for part in end.split('-')]
+    months = []
+    while (year, month) <= (end_year, end_month):
+        months.append('{}-{:02d}'.format(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+@manager.command
+def import_ai(
+        dbs,
+        username='',
+        password='',
+        date='',
+        batch_size=1000,
+        admin_levels=ADMIN_LEVELS,
+        chunk_size=50,
+        notify=True
+):
+    """
+    Imports data from Activity Info,
+    returns a summary of counts and timings for each database
+    """
+
+    with RunMetrics('import_ai', dbs=dbs, date=date) as metrics:
+        db_ids = dbs.split(',')
+        client = ActivityInfoClient(username, password)
+        locations = LocationCache(admin_levels, metrics)
+        summaries = []
+
+        for db_id in db_ids:
+            started = time.time()
+            database = prepare_database(client, db_id, locations, metrics)
+            db_info = database[0]
+            if notify:
+                send_message(
+                    'AI import started for database: {}'.format(db_info['name']),
+                    metrics)
+
+            # 'get all reports for these activities: {}'.format(activities.keys())
+            if not date:  # if no date provided get for the current month
+                date = datetime.date.today().strftime('%Y-%m')
+            if notify:
+                send_message('Pulling reports for date: {}'.format(date), metrics)
+
+            with Stage('import_month', metrics) as stage:
+                writer = import_month(
+                    client, database, date, locations, batch_size, chunk_size,
+                    metrics)
+                stage.rows = writer.created + writer.updated + writer.unchanged
+
+            summaries.append({
+                'db_id': db_id,
+                'db_name': db_info['name'],
+                'date': date,
+                'created': writer.created,
+                'updated': writer.updated,
+                'unchanged': writer.unchanged,
+                'deleted': writer.deleted,
+                'seconds': round(time.time() - started, 1),
+            })
+            print 'Reports for {}: {} inserted, {} updated, {} unchanged, {} deleted'.format(
+                db_id, writer.created, writer.updated, writer.unchanged, writer.deleted)
+            if notify:
+                send_message(
+                    'AI import finished, {} site reports created, {} updated, '
+                    '{} unchanged, {} deleted'.format(
+                        writer.created, writer.updated, writer.unchanged, writer.deleted),
+                    metrics)
+
+        print 'Location cache: {} hits, {} misses'.format(
+            locations.hits, locations.misses)
+        return summaries
+
+
+@manager.option('--dbs', dest='dbs', required=True)
+@manager.option('--start', dest='start', required=True)
+@manager.option('-e', '--end', dest='end', default='')
+@manager.option('-u', '--username', dest='username', default='')
+@manager.option('-p', '--password', dest='password', default='')
+@manager.option('-w', '--workers', dest='workers', default=4)
+@manager.option('-b', '--batch_size', dest='batch_size', default=1000)
+@manager.option('-a', '--admin_levels', dest='admin_levels', default=ADMIN_LEVELS)
+@manager.option('-c', '--chunk_size', dest='chunk_size', default=50)
+def backfill(
+        dbs,
+        start,
+        end='',
+        username='',
+        password='',
+        workers=4,
+        batch_size=1000,
+        admin_levels=ADMIN_LEVELS,
+        chunk_size=50
+):
+    """
+    Imports every month from --start to --end (YYYY-MM, inclusive, defaults
+    to the current month) for the comma separated --dbs. Each database is
+    fetched once and its months imported in parallel. Finished months are
+    checkpointed per database and month, so a later backfill over any
+    range skips them, remove them from ai.backfills to import them again.
+    """
+    with RunMetrics('backfill', dbs=dbs, start=start, end=end) as metrics:
+        if not end:
+            end = datetime.date.today().strftime('%Y-%m')
+        months = month_range(start, end)
+
+        client = ActivityInfoClient(username, password)
+        locations = LocationCache(admin_levels, metrics)
+        pool = ThreadPool(int(workers))
+
+        try:
+            for db_id in dbs.split(','):
+                with Stage('checkpoints', metrics) as stage:
+                    done = set(
+                        checkpoint['month'] for checkpoint in ai.backfills.find({
+                            '_id': {'$in': [
+                                '{}:{}'.format(db_id, month) for month in months]}
+                        })
+                    )
+                    stage.mongo_calls = 1
+                todo = [month for month in months if month not in done]
+                if not todo:
+                    print 'Backfill of {} from {} to {} already done'.format(
+                        db_id, start, end)
+                    continue
+
+                # months share the database, sites and location cache
+                database = prepare_database(client, db_id, locations, metrics)
+
+                def run(month):
+                    with Stage('import_month', metrics) as stage:
+                        writer = import_month(
+                            client, database, month, locations, batch_size, chunk_size,
+                            metrics)
+                        stage.rows = writer.created + writer.updated + writer.unchanged
+                    with Stage('checkpoints', metrics) as stage:
+                        ai.backfills.update(
+                            {'_id': '{}:{}'.format(db_id, month)},
+                            {
+                                'db_id': db_id,
+                                'month': month,
+                                'finished': datetime.datetime.utcnow(),
+                            },
+                            upsert=True
                         )
-                    reports_created += 1
+                        stage.mongo_calls = 1
+                    return month, writer
 
-                report.save()
+                for month, writer in pool.imap_unordered(run, todo):
+                    print 'Backfilled {} {}: {} inserted, {} updated, {} unchanged, {} deleted'.format(
+                        db_id, month, writer.created, writer.updated,
+                        writer.unchanged, writer.deleted)
 
-        send_message('AI import finished, {} site reports created'.format(reports_created))
+                send_message(
+                    'AI backfill finished for database: {}, {} months'.format(
+                        database[0]['name'], len(todo)),
+                    metrics)
+        finally:
+            pool.close()
+            pool.join()
 
 
 # Turn on debugger by default and reloader
@@ -2,10 +2,10 @@ __author__ = 'jcranwellward'
 
 import os
 
-from celery import Celery
+from celery import Celery, chord
 from celery.schedules import crontab
 
-from manage import app, import_ai, update_sites
+from manage import app, import_ai, backfill, update_sites, send_message
 
 
 CELERYBEAT_SCHEDULE = {
@@ -33,6 +33,11 @@ def make_celery(app):
 
 celery = make_celery(app)
 
+# per database import timeout and retry policy, times in seconds
+IMPORT_TIMEOUT = int(os.environ.get('AI_IMPORT_TIMEOUT', 3600))
+IMPORT_RETRIES = int(os.environ.get('AI_IMPORT_RETRIES', 3))
+IMPORT_RETRY_DELAY = int(os.environ.get('AI_IMPORT_RETRY_DELAY', 300))
+
 
 @celery.task
 def run_import():
@@ -41,7 +46,67 @@ def run_import():
     username = os.environ.get('AI_USERNAME')
     password = os.environ.get('AI_PASSWORD')
     if dbs:
-        import_ai(dbs, username, password)
+        # one task per database, the summary runs when they all finish
+        chord(
+            run_db_import.s(db_id, username, password)
+            for db_id in dbs.split(',')
+        )(run_import_summary.s())
+
+
+@celery.task(
+    bind=True,
+    max_retries=IMPORT_RETRIES,
+    default_retry_delay=IMPORT_RETRY_DELAY,
+    soft_time_limit=IMPORT_TIMEOUT,
+    time_limit=IMPORT_TIMEOUT + 60)
+def run_db_import(self, db_id, username, password):
+
+    batch_size = os.environ.get('AI_BATCH_SIZE', 1000)
+    try:
+        return import_ai(
+            db_id,
+            username,
+            password,
+            batch_size=batch_size,
+            notify=False
+        )[0]
+    except Exception as exp:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exp)
+        # report the failure in the summary rather than breaking the chord
+        return {'db_id': db_id, 'error': repr(exp)}
+
+
+@celery.task
+def run_import_summary(summaries):
+
+    lines = ['AI import finished for {} databases'.format(len(summaries))]
+    for summary in summaries:
+        if 'error' in summary:
+            lines.append('{db_id}: failed, {error}'.format(**summary))
+        else:
+            lines.append(
+                u'{db_name} ({db_id}) {date}: {created} created, '
+                u'{updated} updated, {unchanged} unchanged, {deleted} deleted '
+                u'in {seconds}s'.format(**summary)
+            )
+    send_message('\n'.join(lines))
+
+
+@celery.task
+def run_backfill(dbs, start, end=''):
+
+    username = os.environ.get('AI_USERNAME')
+    password = os.environ.get('AI_PASSWORD')
+    batch_size = os.environ.get('AI_BATCH_SIZE', 1000)
+    backfill(
+        dbs,
+        start,
+        end,
+        username,
+        password,
+        batch_size=batch_size
+    )
 
 
 @celery.task